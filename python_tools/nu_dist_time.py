@@ -75,7 +75,7 @@ import time
 
 ###### read surface database
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Reading global parameters...')
     
 if args.multi_file:
@@ -131,25 +131,25 @@ for inc, nc in enumerate(nc_surfs):
 
 
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Reading global parameters done, ' + 
           '%f sec elapsed.\n' % (elapsed))
           
 ###### surface sampling
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Sampling distance...')
 ndists = int((args.max_dist - args.min_dist) / args.dist_interval) + 1
 dists = np.radians(np.linspace(args.min_dist, args.max_dist, ndists))    
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('    Number of distances: %d' % (ndists))
     print('Sampling distance done, ' + 
           '%f sec elapsed.\n' % (elapsed))
           
 ###### prepare theta
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Locating points in distance...')
 # locate element
 max_theta = np.amax(var_theta, axis=1)
@@ -170,13 +170,13 @@ for idist, dist in enumerate(dists):
     real_eta = lbases[pntTags[idist]]    
     real_theta[idist] = (real_eta + 1.) * .5 * (theta_bounds[1] - theta_bounds[0]) + theta_bounds[0]
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Locating points in distance done, ' + 
           '%f sec elapsed.\n' % (elapsed))   
 
 ###### prepare time steps
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Preparing timesteps...')
 if nstep == 1:
     steps = np.array([0])
@@ -195,7 +195,7 @@ else:
     dt = var_time[1] - t0    
     nsteps = len(steps)
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('    Number of snapshots: %d' % (nsteps))
     print('Preparing timesteps done, ' + 
           '%f sec elapsed.\n' % (elapsed))
@@ -215,7 +215,7 @@ def compute_nu(iproc):
 
     # compute nu
     if args.verbose and iproc == 0:
-        clock0 = time.clock()
+        clock0 = time.perf_counter()
         print('Computing nu...')
     for it, istep in enumerate(steps):
         if it % args.nproc != iproc: 
@@ -259,7 +259,7 @@ def compute_nu(iproc):
         os.remove(tempnc)
     
     if args.verbose and iproc == 0:
-        elapsed = time.clock() - clock0
+        elapsed = time.perf_counter() - clock0
         print('Computing nu done, ' + 
               '%f sec elapsed.' % (elapsed))
 
@@ -17,8 +17,13 @@ aim = '''Generate VTK animations from a NetCDF database of surface wavefield
 created by AxiSEM3D (named axisem3d_surface.nc by the solver). Data
 are presented on an unstructured mesh.'''
 
-notes = '''Parallelise data processing using --nporc option.
+notes = '''Parallelise data processing using --using_mpi option.
 Animate the VKT files with Paraview.
+Snapshots are read in batches along time; if the database is chunked 
+(e.g., compressed with nccopy -d), use -v to check the chunk shape and 
+rechunk along time if chunks are narrow in time, e.g.,
+nccopy -c ncdim_NSTEP/128 axisem3d_surface.nc rechunked.nc
+where NSTEP is the number of time steps.
  
 '''
 
@@ -59,11 +64,37 @@ parser.add_argument('-dt', '--time_interval', dest='time_interval',
 parser.add_argument('-nt', '--nsnapshots', dest='nsnapshots',
                     action='store', type=int, required=True,
                     help='number of snapshots <required>')
+parser.add_argument('-b', '--batch', dest='batch', 
+                    action='store', type=int, default=32,
+                    help='number of snapshots read at once\n' +
+                         'from NetCDF; default = 32')
+parser.add_argument('--chunk_cache', dest='chunk_cache', 
+                    action='store', type=int, default=256,
+                    help='maximum HDF5 chunk cache per variable\n' +
+                         'in MB; default = 256')
 parser.add_argument('-N', '--norm', dest='norm', action='store_true', 
                     help='only dump displacement norm;\n' +
                          'default = False (dump 3D vector)')
+parser.add_argument('-H', '--vtkhdf', dest='vtkhdf', action='store_true', 
+                    help='write all snapshots to a single VTKHDF\n' +
+                         'file (surface_vtk.vtkhdf) with h5py;\n' +
+                         'default = False (one vtk file per snapshot)')
 parser.add_argument('-p', '--using_mpi', dest='using_mpi', action='store_true', 
                     help='parallel mode with MPI')                           
+parser.add_argument('-P', '--parallel_netcdf', dest='parallel_netcdf', action='store_true', 
+                    help='read NetCDF with parallel I/O (MPI-IO),\n' +
+                         'requiring netCDF4 with parallel support;\n' +
+                         'only used with --using_mpi')
+parser.add_argument('-j', '--numba', dest='numba', action='store_true', 
+                    help='compute displacement with numba')
+parser.add_argument('--numba_special', dest='numba_special', 
+                    action='store', type=int, default=2,
+                    help='maximum number of orders with specialised\n' +
+                         'numba kernels, compiled on every run and\n' +
+                         'only for orders with 1/4 of the points;\n' +
+                         'default = 2')
+parser.add_argument('-g', '--gpu', dest='gpu', action='store_true', 
+                    help='compute displacement on GPU with cupy')
 parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', 
                     help='verbose mode')        
 # hidden options
@@ -82,9 +113,12 @@ args = parser.parse_args()
 
 import numpy as np
 from netCDF4 import Dataset
-import pyvtk
 import os
 import time
+from collections import defaultdict
+from contextlib import contextmanager
+from queue import Queue
+from threading import Thread, Lock
 
 # mpi
 if args.using_mpi:
@@ -95,6 +129,31 @@ else:
     mpi_size = 1
     mpi_rank = 0
 
+# parallel netcdf
+if args.using_mpi and args.parallel_netcdf:
+    # collective buffering for reads
+    nc_info = MPI.Info.Create()
+    nc_info.Set('romio_cb_read', 'enable')
+    nc_info.Set('cb_buffer_size', str(16 * 1024 * 1024))
+    nc_kwargs = {'parallel': True, 'comm': MPI.COMM_WORLD, 'info': nc_info}
+else:
+    nc_kwargs = {}
+
+# numba
+if args.numba:
+    from numba import njit, prange
+
+# gpu; xp is the array module for computing displacement
+assert not (args.gpu and args.numba), '--gpu and --numba are exclusive'
+if args.gpu:
+    import cupy as xp
+else:
+    xp = np
+
+# vtkhdf
+if args.vtkhdf:
+    import h5py
+
 # slightly increase the radius for plot
 r_plot = 1.0001
 
@@ -127,47 +186,37 @@ CubeToSphere_ups = np.array([
     
 def SpherifiedCube(divisions, zmin, zmax, zsort=True):
     step = 1.0 / divisions
-    step3 = np.array([step, step, step])
-    # vertices
+    # vertices, indexed by (face, j, i) flattened
     k = divisions + 1
     n_vertices_full = 6 * k ** 2
+    faces = np.repeat(np.arange(6), k * k)
+    js = np.tile(np.repeat(np.arange(k), k), 6)
+    iis = np.tile(np.arange(k), 6 * k)
+    p = CubeToSphere_origins[faces] + step * (iis[:, None] * CubeToSphere_rights[faces] + 
+                                              js[:, None] * CubeToSphere_ups[faces])
+    p2 = p * p
     xyz_full = np.zeros((n_vertices_full, 3))
-    mask_full = np.zeros(n_vertices_full, dtype=int)
-    ipnt = 0
-    for face in np.arange(6):
-        origin = CubeToSphere_origins[face]
-        right = CubeToSphere_rights[face]
-        up = CubeToSphere_ups[face]
-        for j in np.arange(k):
-            j3 = np.array([j, j, j])
-            for i in np.arange(k):
-                i3 = np.array([i, i, i])
-                p = origin + step3 * (i3 * right + j3 * up)
-                p2 = p * p
-                z = p[2] * np.sqrt(1.0 - 0.5 * (p2[0] + p2[1]) + p2[0] * p2[1] / 3.0)
-                if z >= zmin and z <= zmax:
-                    xyz_full[ipnt, 0] = p[0] * np.sqrt(1.0 - 0.5 * (p2[1] + p2[2]) + p2[1] * p2[2] / 3.0)
-                    xyz_full[ipnt, 1] = p[1] * np.sqrt(1.0 - 0.5 * (p2[2] + p2[0]) + p2[2] * p2[0] / 3.0)
-                    xyz_full[ipnt, 2] = z
-                    mask_full[ipnt] = 1
-                else:
-                    mask_full[ipnt] = 0
-                ipnt += 1
+    xyz_full[:, 0] = p[:, 0] * np.sqrt(1.0 - 0.5 * (p2[:, 1] + p2[:, 2]) + p2[:, 1] * p2[:, 2] / 3.0)
+    xyz_full[:, 1] = p[:, 1] * np.sqrt(1.0 - 0.5 * (p2[:, 2] + p2[:, 0]) + p2[:, 2] * p2[:, 0] / 3.0)
+    xyz_full[:, 2] = p[:, 2] * np.sqrt(1.0 - 0.5 * (p2[:, 0] + p2[:, 1]) + p2[:, 0] * p2[:, 1] / 3.0)
     
-    # form index map from full to need and xyz_need
-    n_vertices_need = np.sum(mask_full)
-    xyz_need = np.zeros((n_vertices_need, 3))
-    idx_need = np.zeros(n_vertices_need, dtype=int)
-    f2n = np.zeros(n_vertices_full, dtype=int)
-    idx_current = 0
-    for imask, needed in enumerate(mask_full):
-        if needed:
-            xyz_need[idx_current] = xyz_full[imask]
-            idx_need[idx_current] = imask
-            f2n[imask] = idx_current
-            idx_current += 1
-        else:
-            f2n[imask] = -1
+    # vertices on the edges of the cube are shared by two or three faces;
+    # merge them so that each point is sampled only once
+    _, idx_first, full2uniq = np.unique(np.round(xyz_full, 10) + 0., axis=0, 
+                                        return_index=True, return_inverse=True)
+    # keep the first occurrence in (face, j, i) order
+    order = np.argsort(idx_first)
+    xyz_uniq = xyz_full[idx_first[order]]
+    full2uniq = np.argsort(order)[full2uniq.reshape(-1)]
+    n_vertices_uniq = len(xyz_uniq)
+    mask_uniq = np.logical_and(xyz_uniq[:, 2] >= zmin, xyz_uniq[:, 2] <= zmax)
+    
+    # form index map from uniq to need and xyz_need
+    idx_need = np.nonzero(mask_uniq)[0]
+    n_vertices_need = len(idx_need)
+    xyz_need = xyz_uniq[idx_need]
+    u2n = np.full(n_vertices_uniq, -1, dtype=int)
+    u2n[idx_need] = np.arange(n_vertices_need)
             
     # sort by z (theta) to reduce IO access to netcdf database
     if zsort:
@@ -175,22 +224,18 @@ def SpherifiedCube(divisions, zmin, zmax, zsort=True):
         xyz_need = xyz_need[idx_sort]
         # no idea how this works, but it does...
         idx_revs = np.argsort(idx_sort)
-        f2n[idx_need] = f2n[idx_need][idx_revs]
+        u2n[idx_need] = u2n[idx_need][idx_revs]
                 
-	# cells
-    connectivity = []
-    for face in np.arange(6):
-        for j in np.arange(divisions):
-            for i in np.arange(divisions):
-                a = f2n[(face * k + j) * k + i]
-                b = f2n[(face * k + j) * k + i + 1]
-                c = f2n[(face * k + j + 1) * k + i]
-                d = f2n[(face * k + j + 1) * k + i + 1]
-                # skip if one of the vertices are out of z-range
-                if a < 0 or b < 0 or c < 0 or d < 0:
-                    continue
-                connectivity.append([a, c, d, b])
-    aconnectivity = np.array(connectivity)
+    # cells, indexed by (face, j, i) flattened
+    faces = np.repeat(np.arange(6), divisions * divisions)
+    js = np.tile(np.repeat(np.arange(divisions), divisions), 6)
+    iis = np.tile(np.arange(divisions), 6 * divisions)
+    ifull = (faces * k + js) * k + iis
+    f2n = u2n[full2uniq]
+    aconnectivity = np.stack([f2n[ifull], f2n[ifull + k], 
+                              f2n[ifull + k + 1], f2n[ifull + 1]], axis=1)
+    # skip if one of the vertices are out of z-range
+    aconnectivity = aconnectivity[np.all(aconnectivity >= 0, axis=1)]
     
     xyz_need *= r_plot
     return xyz_need, aconnectivity
@@ -198,6 +243,147 @@ def SpherifiedCube(divisions, zmin, zmax, zsort=True):
 ################### MESH TOOLS ###################
 
 
+################### TIMING TOOLS ###################
+# accumulate wall time of a phase into stats[name]
+@contextmanager
+def timed(name, stats):
+    clock0 = time.perf_counter()
+    yield
+    stats[name] += time.perf_counter() - clock0
+
+################### TIMING TOOLS ###################
+
+
+################### VTK TOOLS ###################
+# legacy VTK format in binary (big-endian)
+# https://vtk.org/wp-content/uploads/2015/04/file-formats.pdf
+
+def vtkHeader(xyz, connect, title):
+    npnt = len(xyz)
+    ncell, nvert = connect.shape
+    cells = np.zeros((ncell, nvert + 1), dtype='>i4')
+    cells[:, 0] = nvert
+    cells[:, 1:] = connect
+    # VTK_QUAD = 9
+    cell_types = np.full(ncell, 9, dtype='>i4')
+    return b''.join([
+        b'# vtk DataFile Version 2.0\n', title.encode() + b'\n', 
+        b'BINARY\n', b'DATASET UNSTRUCTURED_GRID\n',
+        b'POINTS %d float\n' % (npnt), xyz.astype('>f4').tobytes(), b'\n',
+        b'CELLS %d %d\n' % (ncell, cells.size), cells.tobytes(), b'\n',
+        b'CELL_TYPES %d\n' % (ncell), cell_types.tobytes(), b'\n',
+        b'POINT_DATA %d\n' % (npnt)])
+        
+def vtkPointData(data, name):
+    if data.ndim == 1:
+        head = b'SCALARS %s float 1\nLOOKUP_TABLE default\n' % (name.encode())
+    else:
+        head = b'VECTORS %s float\n' % (name.encode())
+    return head + data.astype('>f4').tobytes() + b'\n'
+
+# VTKHDF format (version 2.0) with time steps
+# https://docs.vtk.org/en/latest/design_documents/VTKFileFormats.html
+# the mesh is stored once and the point data of all steps are 
+# concatenated, each step being contiguous in the file
+def vtkhdfCreate(fname, xyz, connect, times, name, ncomp, comm=None):
+    if comm is None:
+        fh = h5py.File(fname, 'w')
+    else:
+        fh = h5py.File(fname, 'w', driver='mpio', comm=comm)
+    npnt = len(xyz)
+    ncell, nvert = connect.shape
+    nsteps = len(times)
+    root = fh.create_group('VTKHDF')
+    root.attrs['Version'] = np.array([2, 0], dtype='i8')
+    root.attrs['Type'] = np.bytes_('UnstructuredGrid')
+    # mesh
+    root.create_dataset('NumberOfPoints', data=np.array([npnt], dtype='i8'))
+    root.create_dataset('NumberOfCells', data=np.array([ncell], dtype='i8'))
+    root.create_dataset('NumberOfConnectivityIds', data=np.array([ncell * nvert], dtype='i8'))
+    root.create_dataset('Points', data=xyz.astype('f4'))
+    root.create_dataset('Connectivity', data=connect.reshape(-1).astype('i8'))
+    root.create_dataset('Offsets', data=np.arange(ncell + 1, dtype='i8') * nvert)
+    # VTK_QUAD = 9
+    root.create_dataset('Types', data=np.full(ncell, 9, dtype='u1'))
+    # steps, all sharing the same mesh
+    steps = root.create_group('Steps')
+    steps.attrs['NSteps'] = nsteps
+    steps.create_dataset('Values', data=np.array(times, dtype='f8'))
+    steps.create_dataset('PartOffsets', data=np.zeros(nsteps, dtype='i8'))
+    steps.create_dataset('NumberOfParts', data=np.ones(nsteps, dtype='i8'))
+    steps.create_dataset('PointOffsets', data=np.zeros(nsteps, dtype='i8'))
+    steps.create_dataset('CellOffsets', data=np.zeros((nsteps, 1), dtype='i8'))
+    steps.create_dataset('ConnectivityIdOffsets', data=np.zeros((nsteps, 1), dtype='i8'))
+    steps.create_dataset('PointDataOffsets/' + name, data=np.arange(nsteps, dtype='i8') * npnt)
+    # point data, written step by step
+    shape = (nsteps * npnt, ncomp) if ncomp > 1 else (nsteps * npnt,)
+    data = root.create_dataset('PointData/' + name, shape=shape, dtype='f4')
+    return fh, data
+
+################### VTK TOOLS ###################
+
+
+################### NUMBA KERNELS ###################
+if args.numba:
+    # kernel for nPntEdge = npnt; the loop over GLL points has a 
+    # compile-time bound, and so has the loop over orders if nu is 
+    # given, so that LLVM can unroll and vectorise them; with nu = None,
+    # the kernel is generic in nu_p_1 and cached on disk, otherwise it 
+    # is compiled on every run
+    def makeFillDisp(npnt, nu=None):
+        def fill_disp(disp, ists, igroups, weights, fourier_r, fourier_i, cos_dists, sin_dists, azims, nus):
+            # fourier_r and fourier_i are stacked by group: (ngroup, 3, npnt, nu_max),
+            # with the order of each group in nus;
+            # igroups index the stack for the points ists
+            for i in prange(len(ists)):
+                ist = ists[i]
+                igroup = igroups[i]
+                # nu is a compile-time constant, so this branch is pruned
+                if nu is None:
+                    nu_end = nus[igroup]
+                else:
+                    nu_end = nu
+                # cos(k * azim) and sin(k * azim) by recurrence
+                cos_azim = np.cos(azims[ist])
+                sin_azim = np.sin(azims[ist])
+                cos_k = 1.
+                sin_k = 0.
+                spz0 = 0.
+                spz1 = 0.
+                spz2 = 0.
+                for k in range(nu_end):
+                    w0r = 0.
+                    w1r = 0.
+                    w2r = 0.
+                    w0i = 0.
+                    w1i = 0.
+                    w2i = 0.
+                    for ipnt in range(npnt):
+                        w = weights[ist, ipnt]
+                        w0r += w * fourier_r[igroup, 0, ipnt, k]
+                        w1r += w * fourier_r[igroup, 1, ipnt, k]
+                        w2r += w * fourier_r[igroup, 2, ipnt, k]
+                        w0i += w * fourier_i[igroup, 0, ipnt, k]
+                        w1i += w * fourier_i[igroup, 1, ipnt, k]
+                        w2i += w * fourier_i[igroup, 2, ipnt, k]
+                    # real part of (wr + i wi) * exp(i k azim), doubled for k > 0
+                    factor = 1. if k == 0 else 2.
+                    spz0 += factor * (w0r * cos_k - w0i * sin_k)
+                    spz1 += factor * (w1r * cos_k - w1i * sin_k)
+                    spz2 += factor * (w2r * cos_k - w2i * sin_k)
+                    cos_next = cos_k * cos_azim - sin_k * sin_azim
+                    sin_k = sin_k * cos_azim + cos_k * sin_azim
+                    cos_k = cos_next
+                # SPZ to RTZ
+                disp[ist, 0] = spz0 * cos_dists[ist] - spz2 * sin_dists[ist]
+                disp[ist, 1] = spz1
+                disp[ist, 2] = spz0 * sin_dists[ist] + spz2 * cos_dists[ist]
+        return njit(parallel=True, fastmath=True, boundscheck=False, nogil=True, 
+                    cache=(nu is None))(fill_disp)
+
+################### NUMBA KERNELS ###################
+
+
 ###### read surface database
 if args.multi_file:
     # read index file
@@ -209,7 +395,7 @@ if args.multi_file:
     nc_surfs = []
     for irank in ranks_unique:
         fname = args.in_surface_nc + '/axisem3d_surface.nc.rank' + str(irank)
-        nc = Dataset(fname, 'r')
+        nc = Dataset(fname, 'r', **nc_kwargs)
         nc_surfs.append(nc)
         if args.verbose and mpi_rank == 0:
             print('Done opening nc file %s' % (fname))
@@ -219,7 +405,7 @@ if args.multi_file:
     for i in np.arange(len(edges)):
         edge_nc[edges[i]] = ranks_unique.tolist().index(ranks[i])
 else:
-    nc_surf = Dataset(args.in_surface_nc, 'r')
+    nc_surf = Dataset(args.in_surface_nc, 'r', **nc_kwargs)
     if args.verbose and mpi_rank == 0:
         print('Done opening nc file %s' % (args.in_surface_nc))
     nc_surfs = [nc_surf]
@@ -229,7 +415,7 @@ else:
 ###### read surface database
 if args.verbose and mpi_rank == 0:
     print()
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Reading global parameters...')
 # global attribute
 srclat = nc_surf.source_latitude
@@ -251,7 +437,7 @@ var_GLL = nc_surf.variables['GLL'][:]
 var_GLJ = nc_surf.variables['GLJ'][:]
 nPntEdge = len(var_GLL)
 if args.verbose and mpi_rank == 0:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Reading global parameters done, ' + 
           '%f sec elapsed.\n' % (elapsed))
           
@@ -263,7 +449,7 @@ except OSError:
           
 ###### surface sampling
 if args.verbose and mpi_rank == 0:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Sampling surface...')
 divisions = int(0.5 * np.pi * r_outer / (args.spatial_sampling * 1e3)) + 1
 zmin = np.cos(np.radians(args.max_dist))
@@ -272,7 +458,7 @@ xyz, connect = SpherifiedCube(divisions, zmin, zmax)
 nstation = len(xyz)
 ncell = len(connect)
 if args.verbose and mpi_rank == 0:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('    Number of sampling points: %d' % (nstation))
     print('    Number of quad cells: %d' % (ncell))
     print('Sampling surface done, ' + 
@@ -280,60 +466,66 @@ if args.verbose and mpi_rank == 0:
           
 ###### generate mesh vtk
 if args.verbose and mpi_rank == 0:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Generating vtk mesh...')
-vtk_points = pyvtk.UnstructuredGrid(list(zip(xyz[:,0], xyz[:,1], xyz[:,2])), quad=connect)
+# the mesh is the same for all snapshots
+vtk_header = vtkHeader(xyz, connect, 'surface animation')
 if args.verbose and mpi_rank == 0:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Generating vtk mesh done, ' + 
           '%f sec elapsed.\n' % (elapsed))
     
 ###### dist, azim
 if args.verbose and mpi_rank == 0:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Computing (distances, azimuths) of points...')    
 # dists
 dists = np.arccos(xyz[:, 2] / r_plot)
 azims = np.arctan2(xyz[:, 1], xyz[:, 0])    
 if args.verbose and mpi_rank == 0:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Computing (distances, azimuths) of points done, ' + 
           '%f sec elapsed.\n' % (elapsed))
 
 ###### prepare theta
 def interpLagrange(target, lbases):
     nrow, ncol = lbases.shape
-    results = np.zeros((nrow, ncol))
-    target_dgr = np.tile(np.array([target]).T, (1, ncol - 1))
-    for dgr in np.arange(0, ncol):
-        lbases_dgr = np.tile(lbases[:, [dgr]], (1, ncol - 1))
-        lbases_sub = np.delete(lbases, dgr, axis=1)
-        results[:, dgr] = np.prod(target_dgr - lbases_sub, axis=1) / \
-                          np.prod(lbases_dgr - lbases_sub, axis=1)
-    return results
+    # exclude the self term of each basis from the products
+    offdiag = np.logical_not(np.eye(ncol, dtype=bool))
+    # (nrow, 1, ncol) and (nrow, ncol, ncol), broadcast against offdiag
+    diff_target = np.array(target)[:, None, None] - lbases[:, None, :]
+    diff_lbases = lbases[:, :, None] - lbases[:, None, :]
+    return np.prod(np.where(offdiag, diff_target, 1.), axis=-1) / \
+           np.prod(np.where(offdiag, diff_lbases, 1.), axis=-1)
 
 if args.verbose and mpi_rank == 0:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Locating points in distance...')
 # locate element
 max_theta = np.amax(var_theta, axis=1)
 eleTags = np.searchsorted(max_theta, dists)
 # compute weights
 lbases = np.tile(var_GLL, (nstation, 1))
-for ist in np.arange(nstation):
-    if eleTags[ist] == 0 or eleTags[ist] == nele - 1:
-        lbases[ist, :] = var_GLJ[:]
+# GLJ for axial elements
+lbases[np.logical_or(eleTags == 0, eleTags == nele - 1)] = var_GLJ
 theta_bounds = var_theta[eleTags, :]
 etas = (dists - theta_bounds[:, 0]) / (theta_bounds[:, 1] - theta_bounds[:, 0]) * 2. - 1.
-weights = interpLagrange(etas, lbases)
+# weights are built in float64 and used in float32, 
+# matching the Fourier coefficients
+weights = np.ascontiguousarray(interpLagrange(etas, lbases), dtype=np.float32)
+# group points by element so that each element is read only once
+# per snapshot, regardless of the order of points
+group_tags, igroups = np.unique(eleTags, return_inverse=True)
+group_points = np.split(np.argsort(igroups, kind='stable'), 
+                        np.cumsum(np.bincount(igroups))[:-1])
 if args.verbose and mpi_rank == 0:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Locating points in distance done, ' + 
           '%f sec elapsed.\n' % (elapsed))    
 
 ###### prepare time steps
 if args.verbose and mpi_rank == 0:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Preparing timesteps...')
 if nstep == 1:
     steps = np.array([0])
@@ -351,18 +543,88 @@ else:
         steps = steps[steps>0]
     dt = var_time[1] - t0    
 if args.verbose and mpi_rank == 0:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('    Number of snapshots: %d' % (len(steps)))
     print('Preparing timesteps done, ' + 
           '%f sec elapsed.\n' % (elapsed))
 
 
-# write vtk
+###### variables of elements
+# keep the NetCDF variables to avoid repeated lookups
+var_fourier_r = {}
+var_fourier_i = {}
+nus = np.zeros(len(group_tags), dtype=int)
+for igroup, etag in enumerate(group_tags):
+    if (edge_nc is None):
+        nc = nc_surf
+    else:
+        nc = nc_surfs[edge_nc[etag]]
+    var_fourier_r[etag] = nc.variables['edge_' + str(etag) + 'r']
+    var_fourier_i[etag] = nc.variables['edge_' + str(etag) + 'i']
+    if nc_kwargs:
+        var_fourier_r[etag].set_collective(True)
+        var_fourier_i[etag].set_collective(True)
+    nus[igroup] = int(var_fourier_r[etag].shape[1] / nPntEdge / 3)
+    # cache one layer of chunks along time, so that a chunk read 
+    # once serves all the snapshots it covers
+    for var in [var_fourier_r[etag], var_fourier_i[etag]]:
+        chunking = var.chunking()
+        if chunking == 'contiguous':
+            continue
+        nchunk_col = int(np.ceil(var.shape[1] / chunking[1]))
+        cache_size = chunking[0] * chunking[1] * nchunk_col * var.dtype.itemsize
+        var.set_var_chunk_cache(size=min(cache_size, args.chunk_cache * 1024 * 1024), 
+            nelems=1009, preemption=0.75)
 if args.verbose and mpi_rank == 0:
-    clock0 = time.clock()
-    print('Generating snapshot...')
-    
-for it, istep in enumerate(steps):
+    print('Chunking of Fourier coefficients: ' + 
+        str(var_fourier_r[group_tags[0]].chunking()))
+
+###### azimuthal expansion and rotation
+# independent of time, computed once for all snapshots;
+# real and imaginary parts of 2 * exp(i m azim) are kept separately
+# so that only the real part of the sum is computed in float32;
+# with --gpu, these and the weights stay on device
+group_points_xp = []
+group_weights = []
+group_cos_exp = []
+group_sin_exp = []
+for igroup, ists in enumerate(group_points):
+    phases = np.outer(azims[ists], np.arange(0, nus[igroup]))
+    factors = np.full(nus[igroup], 2.)
+    factors[0] = 1.
+    group_points_xp.append(xp.asarray(ists))
+    group_weights.append(xp.asarray(weights[ists]))
+    group_cos_exp.append(xp.asarray(np.cos(phases) * factors, dtype=np.float32))
+    group_sin_exp.append(xp.asarray(np.sin(phases) * factors, dtype=np.float32))
+cos_dists = xp.asarray(np.cos(dists), dtype=np.float32)
+sin_dists = xp.asarray(np.sin(dists), dtype=np.float32)
+
+# numba kernels: the orders nu_p_1 with the most points get 
+# specialised kernels, and the others share the generic kernel;
+# a specialised kernel costs a compilation on every run, so it is 
+# only built for an order with at least a quarter of the points;
+# each task is (kernel, groups, points, index of group in stack, stack width)
+if args.numba:
+    nu_values, nu_counts = np.unique(nus[igroups], return_counts=True)
+    nu_special = nu_values[np.argsort(-nu_counts, kind='stable')[:args.numba_special]]
+    nu_special = nu_special[nu_counts[np.searchsorted(nu_values, nu_special)] >= nstation / 4]
+    numba_tasks = []
+    for nu in nu_special.tolist():
+        groups = np.nonzero(nus == nu)[0]
+        numba_tasks.append((makeFillDisp(nPntEdge, nu), groups, nu))
+    groups = np.nonzero(np.logical_not(np.isin(nus, nu_special)))[0]
+    if len(groups) > 0:
+        numba_tasks.append((makeFillDisp(nPntEdge), groups, np.max(nus[groups])))
+    for itask, (kernel, groups, width) in enumerate(numba_tasks):
+        points = np.nonzero(np.isin(igroups, groups))[0]
+        numba_tasks[itask] = (kernel, groups, points, 
+                              np.searchsorted(groups, igroups[points]), width)
+    if args.verbose and mpi_rank == 0:
+        print('Numba kernels specialised for orders: ' + str(nu_special.tolist()))
+
+# snapshots to write
+its_all = []
+for it in np.arange(len(steps)):
     # min/max step
     if args.min_step is not None:
         if it < args.min_step:
@@ -370,63 +632,225 @@ for it, istep in enumerate(steps):
     if args.max_step is not None:
         if it > args.max_step:
             continue  
-    if it % mpi_size != mpi_rank:
-        continue         
-    
-    if args.verbose:
-        clock0s = time.clock()
-        
-    # output        
+    its_all.append(it)
+its_all = np.array(its_all, dtype=int)
+# snapshots on this rank, as a contiguous range so that 
+# each rank reads contiguous hyperslabs
+nits_rank = int(np.ceil(len(its_all) / mpi_size))
+its_rank = its_all[mpi_rank * nits_rank:(mpi_rank + 1) * nits_rank]
+batch = max(args.batch, 1)
+
+# vtkhdf file shared by all ranks
+if args.vtkhdf:
+    if mpi_size > 1:
+        assert h5py.get_config().mpi, 'h5py with MPI support is required ' + \
+            'to write a VTKHDF file in parallel mode'
+        comm = MPI.COMM_WORLD
+    else:
+        comm = None
     if args.norm:
-        disp_norm = np.zeros(nstation)
+        vtk_name, vtk_ncomp = 'disp_norm', 1
     else:
-        disp = np.zeros((nstation, 3))
-        
-    eleTag_last = -1
-    fmat_last = None
-    for istation, dist in enumerate(dists):
-        etag = eleTags[istation]
-        if etag == eleTag_last:
-            fmat = fmat_last
-            nu_p_1 = fmat.shape[-1]
+        vtk_name, vtk_ncomp = 'disp_RTZ', 3
+    vtkhdf_file, vtkhdf_data = vtkhdfCreate(args.out_vtk + '/surface_vtk.vtkhdf', 
+        xyz, connect, var_time[steps[its_all]], vtk_name, vtk_ncomp, comm)
+
+# write vtk
+if args.verbose and mpi_rank == 0:
+    clock0 = time.perf_counter()
+    print('Generating snapshot...')
+# time spent in each phase on this rank; read_nc and vtk_write 
+# run in their own threads and overlap with the others; with --gpu, 
+# device work is asynchronous and mostly shows up in rotate
+stats = defaultdict(float)
+    
+# pipeline: a reader thread prefetches batches of Fourier coefficients,
+# the main thread computes and a writer thread dumps the snapshots, 
+# so that reading, computing and writing overlap
+# HDF5 is not thread-safe, so calls from the reader and the 
+# writer (with --vtkhdf) are serialised
+hdf5_lock = Lock()
+# bounded queues: read_q in batches, write_q in snapshots
+read_q = Queue(maxsize=2)
+write_q = Queue(maxsize=4)
+errors = []
+
+nbatch = int(np.ceil(len(its_rank) / batch))
+if nc_kwargs:
+    # collective reads must be issued by all ranks, 
+    # including those with fewer batches
+    nbatch = MPI.COMM_WORLD.allreduce(nbatch, op=MPI.MAX)
+
+# hyperslabs of a batch as (selection, rows to keep): evenly spaced steps
+# are read as one (strided) hyperslab, dense steps as one covering 
+# hyperslab, and sparse steps one by one to avoid reading unused steps
+def batchHyperslabs(steps_batch):
+    if len(steps_batch) == 0:
+        return []
+    diffs = np.diff(steps_batch)
+    if len(diffs) == 0 or (diffs[0] > 0 and np.all(diffs == diffs[0])):
+        stride = diffs[0] if len(diffs) > 0 else 1
+        return [(slice(steps_batch[0], steps_batch[-1] + 1, stride), slice(None))]
+    if steps_batch[-1] - steps_batch[0] + 1 <= 2 * len(steps_batch):
+        return [(slice(steps_batch[0], steps_batch[-1] + 1), steps_batch - steps_batch[0])]
+    return [(slice(step, step + 1), slice(None)) for step in steps_batch]
+
+batch_hyperslabs = [batchHyperslabs(steps[its_rank[ibatch:ibatch + batch]]) 
+                    for ibatch in np.arange(0, nbatch * batch, batch)]
+if nc_kwargs:
+    # collective reads must be issued the same number of times by all 
+    # ranks, so a rank with fewer hyperslabs in a batch reads one step 
+    # and discards it; netCDF4 skips the read of an empty hyperslab
+    nreads = np.array([len(hyperslabs) for hyperslabs in batch_hyperslabs], dtype=np.int64)
+    MPI.COMM_WORLD.Allreduce(MPI.IN_PLACE, nreads, op=MPI.MAX)
+    for hyperslabs, nread in zip(batch_hyperslabs, nreads):
+        hyperslabs += [(slice(0, 1), slice(0, 0))] * (nread - len(hyperslabs))
+
+def reader():
+    try:
+        for ibatch, hyperslabs in zip(np.arange(0, nbatch * batch, batch), batch_hyperslabs):
+            # stop early if the writer has failed; with parallel NetCDF, 
+            # the collective reads are still issued and the data discarded
+            if errors and not nc_kwargs:
+                break
+            its_batch = its_rank[ibatch:ibatch + batch]
+            # real and imaginary parts: (snapshot, 2, 3 * nPntEdge * nu_p_1) in float32
+            fourier_batch = {}
+            with timed('read_nc', stats), hdf5_lock:
+                for igroup, etag in enumerate(group_tags):
+                    fourier = np.zeros((len(its_batch), 2, 3 * nPntEdge * nus[igroup]), dtype=np.float32)
+                    irow = 0
+                    for hyperslab, keep in hyperslabs:
+                        rows_r = var_fourier_r[etag][hyperslab, :][keep]
+                        nrow = len(rows_r)
+                        fourier[irow:irow + nrow, 0, :] = rows_r
+                        fourier[irow:irow + nrow, 1, :] = var_fourier_i[etag][hyperslab, :][keep]
+                        irow += nrow
+                    # one host-to-device copy per element per batch with --gpu
+                    fourier_batch[etag] = xp.asarray(fourier)
+            if errors:
+                continue
+            if args.numba:
+                # stack by task, padded to the width of the task
+                with timed('numba_stack', stats):
+                    fourier_stack = []
+                    for kernel, groups, points, igroups_task, width in numba_tasks:
+                        shape_stack = (len(its_batch), len(groups), 3, nPntEdge, width)
+                        fourier_stack_r = np.zeros(shape_stack, dtype=np.float32)
+                        fourier_stack_i = np.zeros(shape_stack, dtype=np.float32)
+                        for igroup_task, igroup in enumerate(groups):
+                            nu = nus[igroup]
+                            fmat = fourier_batch[group_tags[igroup]].reshape(len(its_batch), 2, 3, nPntEdge, nu)
+                            fourier_stack_r[:, igroup_task, :, :, :nu] = fmat[:, 0]
+                            fourier_stack_i[:, igroup_task, :, :, :nu] = fmat[:, 1]
+                        fourier_stack.append((fourier_stack_r, fourier_stack_i))
+                fourier_batch = fourier_stack
+            read_q.put((its_batch, fourier_batch))
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        read_q.put(None)
+
+def writer():
+    while True:
+        item = write_q.get()
+        if item is None:
+            break
+        if errors:
+            # keep draining so that the main thread never blocks
+            continue
+        it, disp, clock0s = item
+        try:
+            with timed('vtk_write', stats):
+                if args.norm:
+                    disp_out = np.linalg.norm(disp, axis=1)
+                    vtk_name = 'disp_norm'
+                else:
+                    disp_out = disp
+                    vtk_name = 'disp_RTZ'
+                if args.vtkhdf:
+                    ipos = np.searchsorted(its_all, it)
+                    with hdf5_lock:
+                        vtkhdf_data[ipos * nstation:(ipos + 1) * nstation] = disp_out
+                else:
+                    with open(args.out_vtk + '/surface_vtk.' + str(it) + '.vtk', 'wb') as fvtk:
+                        fvtk.write(vtk_header)
+                        fvtk.write(vtkPointData(disp_out, vtk_name))
+            if args.verbose:
+                elapsed = time.perf_counter() - clock0s
+                print('    Done with snapshot t = %f s; tstep = %d / %d, rank = %d, elapsed = %f' \
+                    % (var_time[steps[it]], it + 1, len(steps), mpi_rank, elapsed))
+        except BaseException as e:
+            errors.append(e)
+
+# daemon threads do not hold the process if the main thread fails
+thread_reader = Thread(target=reader, daemon=True)
+thread_writer = Thread(target=writer, daemon=True)
+thread_reader.start()
+thread_writer.start()
+while True:
+    item = read_q.get()
+    # stop early if the reader or the writer has failed
+    if item is None or errors:
+        break
+    its_batch, fourier_batch = item
+    
+    for it_local, it in enumerate(its_batch):
+        if errors:
+            break
+        if args.verbose:
+            clock0s = time.perf_counter()
         else:
-            if (edge_nc is None):
-                nc = nc_surf
-            else:
-                nc = nc_surfs[edge_nc[etag]]
-            fourier_r = nc.variables['edge_' + str(etag) + 'r'][istep, :]
-            fourier_i = nc.variables['edge_' + str(etag) + 'i'][istep, :]
-            fourier = fourier_r[:] + fourier_i[:] * 1j
-            nu_p_1 = int(len(fourier) / nPntEdge / 3)
-            fmat = fourier.reshape(3, nPntEdge, nu_p_1)
-            fmat_last = fmat
-            eleTag_last = etag
-        wdotf = np.tensordot(weights[istation], fmat, ([0], [1]))
-        exparray = 2. * np.exp(np.arange(0, nu_p_1) * 1j * azims[istation])
-        exparray[0] = 1.
-        spz = wdotf.dot(exparray).real
-        if args.norm:
-            disp_norm[istation] = np.linalg.norm(spz)
+            clock0s = None
+            
+        if args.numba:
+            with timed('numba_kernel', stats):
+                disp = np.zeros((nstation, 3), dtype=np.float32)
+                for itask, (kernel, groups, points, igroups_task, width) in enumerate(numba_tasks):
+                    fourier_stack_r, fourier_stack_i = fourier_batch[itask]
+                    kernel(disp, points, igroups_task, weights, 
+                        fourier_stack_r[it_local], fourier_stack_i[it_local], 
+                        cos_dists, sin_dists, azims, nus[groups])
         else:
-            disp[istation, 0] = spz[0] * np.cos(dist) - spz[2] * np.sin(dist)
-            disp[istation, 1] = spz[1]
-            disp[istation, 2] = spz[0] * np.sin(dist) + spz[2] * np.cos(dist)
-    if args.norm:
-        vtk = pyvtk.VtkData(vtk_points,
-            pyvtk.PointData(pyvtk.Scalars(disp_norm, name='disp_norm')), 
-            'surface animation')
-    else:
-        vtk = pyvtk.VtkData(vtk_points,
-            pyvtk.PointData(pyvtk.Vectors(disp, name='disp_RTZ')),
-            'surface animation')
-    vtk.tofile(args.out_vtk + '/surface_vtk.' + str(it) + '.vtk', 'binary')
-    if args.verbose:
-        elapsed = time.clock() - clock0s
-        print('    Done with snapshot t = %f s; tstep = %d / %d, rank = %d, elapsed = %f' \
-            % (var_time[istep], it + 1, len(steps), mpi_rank, elapsed))
+            # spz of all points, computed element by element
+            spz = xp.zeros((nstation, 3), dtype=np.float32)
+            for igroup, ists in enumerate(group_points_xp):
+                with timed('interp_dot', stats):
+                    fmat = fourier_batch[group_tags[igroup]][it_local].reshape(2, 3, nPntEdge, nus[igroup])
+                    # (point, GLL) x (real/imag, dim, GLL, order) -> (point, real/imag, dim, order)
+                    wdotf = xp.tensordot(group_weights[igroup], fmat, ([1], [2]))
+                with timed('azim_sum', stats):
+                    # real part of the azimuthal sum
+                    spz[ists] = xp.einsum('sdk,sk->sd', wdotf[:, 0], group_cos_exp[igroup]) - \
+                                xp.einsum('sdk,sk->sd', wdotf[:, 1], group_sin_exp[igroup])
+            # SPZ to RTZ
+            with timed('rotate', stats):
+                disp = xp.zeros((nstation, 3), dtype=np.float32)
+                disp[:, 0] = spz[:, 0] * cos_dists - spz[:, 2] * sin_dists
+                disp[:, 1] = spz[:, 1]
+                disp[:, 2] = spz[:, 0] * sin_dists + spz[:, 2] * cos_dists
+                if args.gpu:
+                    # only the displacement is copied back to host
+                    disp = xp.asnumpy(disp)
+        # output
+        write_q.put((it, disp, clock0s))
+write_q.put(None)
+# drain read_q so that the reader is not blocked if stopped early
+while item is not None:
+    item = read_q.get()
+thread_reader.join()
+thread_writer.join()
+
+# closing is collective with mpio, so also done on error
+if args.vtkhdf:
+    vtkhdf_file.close()
+if errors:
+    raise errors[0]
 
 if args.verbose and mpi_rank == 0:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Generating snapshots done, ' + 
           '%f sec elapsed.' % (elapsed))
-
+if args.verbose:
+    print('    Timing on rank %d: ' % (mpi_rank) + 
+          ', '.join(['%s = %f s' % (name, stats[name]) for name in stats.keys()]))
@@ -25,7 +25,7 @@ This script visualises displacement curl in the vertical direction;
 gradient calculation is FD-based and is NOT accurate.
 -------------------------------------------------------------------'''
 
-notes = '''Parallelise data processing using --nporc option.
+notes = '''Parallelise data processing using --nproc option.
 Animate the VKT files with Paraview.
  
 '''
@@ -65,7 +65,7 @@ parser.add_argument('-n', '--nsnapshots', dest='nsnapshots',
                     help='number of snapshots <required>')
 parser.add_argument('-p', '--nproc', dest='nproc', action='store', 
                     type=int, default=1, 
-                    help='number of processors; default = 1')
+                    help='number of threads; default = 1')
 parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', 
                     help='verbose mode')        
 # hidden options
@@ -84,8 +84,9 @@ args = parser.parse_args()
 
 import numpy as np
 from netCDF4 import Dataset
-import pyvtk, os, shutil
-from multiprocessing import Pool
+import os
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
 # slightly increase the radius for plot
@@ -120,47 +121,37 @@ CubeToSphere_ups = np.array([
     
 def SpherifiedCube(divisions, zmin, zmax, zsort=True):
     step = 1.0 / divisions
-    step3 = np.array([step, step, step])
-    # vertices
+    # vertices, indexed by (face, j, i) flattened
     k = divisions + 1
     n_vertices_full = 6 * k ** 2
+    faces = np.repeat(np.arange(6), k * k)
+    js = np.tile(np.repeat(np.arange(k), k), 6)
+    iis = np.tile(np.arange(k), 6 * k)
+    p = CubeToSphere_origins[faces] + step * (iis[:, None] * CubeToSphere_rights[faces] + 
+                                              js[:, None] * CubeToSphere_ups[faces])
+    p2 = p * p
     xyz_full = np.zeros((n_vertices_full, 3))
-    mask_full = np.zeros(n_vertices_full, dtype=int)
-    ipnt = 0
-    for face in np.arange(6):
-        origin = CubeToSphere_origins[face]
-        right = CubeToSphere_rights[face]
-        up = CubeToSphere_ups[face]
-        for j in np.arange(k):
-            j3 = np.array([j, j, j])
-            for i in np.arange(k):
-                i3 = np.array([i, i, i])
-                p = origin + step3 * (i3 * right + j3 * up)
-                p2 = p * p
-                z = p[2] * np.sqrt(1.0 - 0.5 * (p2[0] + p2[1]) + p2[0] * p2[1] / 3.0)
-                if z >= zmin and z <= zmax:
-                    xyz_full[ipnt, 0] = p[0] * np.sqrt(1.0 - 0.5 * (p2[1] + p2[2]) + p2[1] * p2[2] / 3.0)
-                    xyz_full[ipnt, 1] = p[1] * np.sqrt(1.0 - 0.5 * (p2[2] + p2[0]) + p2[2] * p2[0] / 3.0)
-                    xyz_full[ipnt, 2] = z
-                    mask_full[ipnt] = 1
-                else:
-                    mask_full[ipnt] = 0
-                ipnt += 1
+    xyz_full[:, 0] = p[:, 0] * np.sqrt(1.0 - 0.5 * (p2[:, 1] + p2[:, 2]) + p2[:, 1] * p2[:, 2] / 3.0)
+    xyz_full[:, 1] = p[:, 1] * np.sqrt(1.0 - 0.5 * (p2[:, 2] + p2[:, 0]) + p2[:, 2] * p2[:, 0] / 3.0)
+    xyz_full[:, 2] = p[:, 2] * np.sqrt(1.0 - 0.5 * (p2[:, 0] + p2[:, 1]) + p2[:, 0] * p2[:, 1] / 3.0)
     
-    # form index map from full to need and xyz_need
-    n_vertices_need = np.sum(mask_full)
-    xyz_need = np.zeros((n_vertices_need, 3))
-    idx_need = np.zeros(n_vertices_need, dtype=int)
-    f2n = np.zeros(n_vertices_full, dtype=int)
-    idx_current = 0
-    for imask, needed in enumerate(mask_full):
-        if needed:
-            xyz_need[idx_current] = xyz_full[imask]
-            idx_need[idx_current] = imask
-            f2n[imask] = idx_current
-            idx_current += 1
-        else:
-            f2n[imask] = -1
+    # vertices on the edges of the cube are shared by two or three faces;
+    # merge them so that each point is sampled only once
+    _, idx_first, full2uniq = np.unique(np.round(xyz_full, 10) + 0., axis=0, 
+                                        return_index=True, return_inverse=True)
+    # keep the first occurrence in (face, j, i) order
+    order = np.argsort(idx_first)
+    xyz_uniq = xyz_full[idx_first[order]]
+    full2uniq = np.argsort(order)[full2uniq.reshape(-1)]
+    n_vertices_uniq = len(xyz_uniq)
+    mask_uniq = np.logical_and(xyz_uniq[:, 2] >= zmin, xyz_uniq[:, 2] <= zmax)
+    
+    # form index map from uniq to need and xyz_need
+    idx_need = np.nonzero(mask_uniq)[0]
+    n_vertices_need = len(idx_need)
+    xyz_need = xyz_uniq[idx_need]
+    u2n = np.full(n_vertices_uniq, -1, dtype=int)
+    u2n[idx_need] = np.arange(n_vertices_need)
             
     # sort by z (theta) to reduce IO access to netcdf database
     if zsort:
@@ -168,22 +159,18 @@ def SpherifiedCube(divisions, zmin, zmax, zsort=True):
         xyz_need = xyz_need[idx_sort]
         # no idea how this works, but it does...
         idx_revs = np.argsort(idx_sort)
-        f2n[idx_need] = f2n[idx_need][idx_revs]
+        u2n[idx_need] = u2n[idx_need][idx_revs]
                 
-	# cells
-    connectivity = []
-    for face in np.arange(6):
-        for j in np.arange(divisions):
-            for i in np.arange(divisions):
-                a = f2n[(face * k + j) * k + i]
-                b = f2n[(face * k + j) * k + i + 1]
-                c = f2n[(face * k + j + 1) * k + i]
-                d = f2n[(face * k + j + 1) * k + i + 1]
-                # skip if one of the vertices are out of z-range
-                if a < 0 or b < 0 or c < 0 or d < 0:
-                    continue
-                connectivity.append([a, c, d, b])
-    aconnectivity = np.array(connectivity)
+    # cells, indexed by (face, j, i) flattened
+    faces = np.repeat(np.arange(6), divisions * divisions)
+    js = np.tile(np.repeat(np.arange(divisions), divisions), 6)
+    iis = np.tile(np.arange(divisions), 6 * divisions)
+    ifull = (faces * k + js) * k + iis
+    f2n = u2n[full2uniq]
+    aconnectivity = np.stack([f2n[ifull], f2n[ifull + k], 
+                              f2n[ifull + k + 1], f2n[ifull + 1]], axis=1)
+    # skip if one of the vertices are out of z-range
+    aconnectivity = aconnectivity[np.all(aconnectivity >= 0, axis=1)]
     
     xyz_need *= r_plot
     return xyz_need, aconnectivity
@@ -191,9 +178,39 @@ def SpherifiedCube(divisions, zmin, zmax, zsort=True):
 ################### MESH TOOLS ###################
 
 
+################### VTK TOOLS ###################
+# legacy VTK format in binary (big-endian)
+# https://vtk.org/wp-content/uploads/2015/04/file-formats.pdf
+
+def vtkHeader(xyz, connect, title):
+    npnt = len(xyz)
+    ncell, nvert = connect.shape
+    cells = np.zeros((ncell, nvert + 1), dtype='>i4')
+    cells[:, 0] = nvert
+    cells[:, 1:] = connect
+    # VTK_QUAD = 9
+    cell_types = np.full(ncell, 9, dtype='>i4')
+    return b''.join([
+        b'# vtk DataFile Version 2.0\n', title.encode() + b'\n', 
+        b'BINARY\n', b'DATASET UNSTRUCTURED_GRID\n',
+        b'POINTS %d float\n' % (npnt), xyz.astype('>f4').tobytes(), b'\n',
+        b'CELLS %d %d\n' % (ncell, cells.size), cells.tobytes(), b'\n',
+        b'CELL_TYPES %d\n' % (ncell), cell_types.tobytes(), b'\n',
+        b'POINT_DATA %d\n' % (npnt)])
+        
+def vtkPointData(data, name):
+    if data.ndim == 1:
+        head = b'SCALARS %s float 1\nLOOKUP_TABLE default\n' % (name.encode())
+    else:
+        head = b'VECTORS %s float\n' % (name.encode())
+    return head + data.astype('>f4').tobytes() + b'\n'
+
+################### VTK TOOLS ###################
+
+
 ###### read surface database
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Reading global parameters...')
 nc_surf = Dataset(args.in_surface_nc, 'r')
 # global attribute
@@ -216,7 +233,7 @@ var_GLL = nc_surf.variables['GLL'][:]
 var_GLJ = nc_surf.variables['GLJ'][:]
 nPntEdge = len(var_GLL)
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Reading global parameters done, ' + 
           '%f sec elapsed.\n' % (elapsed))
           
@@ -228,7 +245,7 @@ except OSError:
           
 ###### surface sampling
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Sampling surface...')
 divisions = int(0.5 * np.pi * r_outer / (args.spatial_sampling * 1e3)) + 1
 zmin = np.cos(np.radians(args.max_dist))
@@ -237,7 +254,7 @@ xyz, connect = SpherifiedCube(divisions, zmin, zmax)
 nstation = len(xyz)
 ncell = len(connect)
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('    Number of sampling points: %d' % (nstation))
     print('    Number of quad cells: %d' % (ncell))
     print('Sampling surface done, ' + 
@@ -245,49 +262,48 @@ if args.verbose:
           
 ###### generate mesh vtk
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Generating vtk mesh...')
-vtk_points = pyvtk.UnstructuredGrid(list(zip(xyz[:,0], xyz[:,1], xyz[:,2])), quad=connect)
+# the mesh is the same for all snapshots
+vtk_header = vtkHeader(xyz, connect, 'surface animation')
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Generating vtk mesh done, ' + 
           '%f sec elapsed.\n' % (elapsed))
     
 ###### dist, azim
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Computing (distances, azimuths) of points...')    
 # dists
 dists = np.arccos(xyz[:, 2] / r_plot)
 azims = np.arctan2(xyz[:, 1], xyz[:, 0])    
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Computing (distances, azimuths) of points done, ' + 
           '%f sec elapsed.\n' % (elapsed))
 
 ###### prepare theta
 def interpLagrange(target, lbases):
     nrow, ncol = lbases.shape
-    results = np.zeros((nrow, ncol))
-    target_dgr = np.tile(np.array([target]).T, (1, ncol - 1))
-    for dgr in np.arange(0, ncol):
-        lbases_dgr = np.tile(lbases[:, [dgr]], (1, ncol - 1))
-        lbases_sub = np.delete(lbases, dgr, axis=1)
-        results[:, dgr] = np.prod(target_dgr - lbases_sub, axis=1) / \
-                          np.prod(lbases_dgr - lbases_sub, axis=1)
-    return results
+    # exclude the self term of each basis from the products
+    offdiag = np.logical_not(np.eye(ncol, dtype=bool))
+    # (nrow, 1, ncol) and (nrow, ncol, ncol), broadcast against offdiag
+    diff_target = np.array(target)[:, None, None] - lbases[:, None, :]
+    diff_lbases = lbases[:, :, None] - lbases[:, None, :]
+    return np.prod(np.where(offdiag, diff_target, 1.), axis=-1) / \
+           np.prod(np.where(offdiag, diff_lbases, 1.), axis=-1)
 
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Locating points in distance...')
 # locate element
 max_theta = np.amax(var_theta, axis=1)
 eleTags = np.searchsorted(max_theta, dists)
 # compute weights
 lbases = np.tile(var_GLL, (nstation, 1))
-for ist in np.arange(nstation):
-    if eleTags[ist] == 0 or eleTags[ist] == nele - 1:
-        lbases[ist, :] = var_GLJ[:]
+# GLJ for axial elements
+lbases[np.logical_or(eleTags == 0, eleTags == nele - 1)] = var_GLJ
 theta_bounds = var_theta[eleTags, :]
 etas = (dists - theta_bounds[:, 0]) / (theta_bounds[:, 1] - theta_bounds[:, 0]) * 2. - 1.
 weights = interpLagrange(etas, lbases)
@@ -307,14 +323,21 @@ assert len(eleTags[np.nonzero(eleTags1 - eleTags)]) == 0
 etas1 = (dists1 - theta_bounds[:, 0]) / (theta_bounds[:, 1] - theta_bounds[:, 0]) * 2. - 1.
 weights1 = interpLagrange(etas1, lbases)
 ######################################################
+# group points by element so that each element is read only once
+# per snapshot, regardless of the order of points
+group_tags, igroups = np.unique(eleTags, return_inverse=True)
+group_points = np.split(np.argsort(igroups, kind='stable'), 
+                        np.cumsum(np.bincount(igroups))[:-1])
+# poles cannot be computed correctly
+inner = np.logical_and(dists >= delta, dists <= np.pi - delta)
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('Locating points in distance done, ' + 
           '%f sec elapsed.\n' % (elapsed))    
 
 ###### prepare time steps
 if args.verbose:
-    clock0 = time.clock()
+    clock0 = time.perf_counter()
     print('Preparing timesteps...')
 if nstep == 1:
     steps = np.array([0])
@@ -332,100 +355,96 @@ else:
         steps = steps[steps>0]
     dt = var_time[1] - t0    
 if args.verbose:
-    elapsed = time.clock() - clock0
+    elapsed = time.perf_counter() - clock0
     print('    Number of snapshots: %d' % (len(steps)))
     print('Preparing timesteps done, ' + 
           '%f sec elapsed.\n' % (elapsed))
 
-# close serial input    
-nc_surf.close()
-def write_vtk(iproc):
-    if args.nproc == 1:
-        nc_surf_local = Dataset(args.in_surface_nc, 'r')
-        iproc = 0
-    else:
-        # copy netcdf file for parallel access
-        tempnc = args.out_vtk + '/surface_temp.nc' + str(iproc)
-        shutil.copy(args.in_surface_nc, tempnc)
-        nc_surf_local = Dataset(tempnc, 'r')
+# azimuthal expansion at the point and at its neighbour in azimuth,
+# independent of time and computed once for all snapshots
+group_exparrays = []
+group_exparrays1 = []
+for igroup, ists in enumerate(group_points):
+    var_fourier_r = nc_surf.variables['edge_' + str(group_tags[igroup]) + 'r']
+    orders = np.arange(0, int(var_fourier_r.shape[1] / nPntEdge / 3))
+    exparray = 2. * np.exp(np.outer(azims[ists], orders) * 1j)
+    exparray[:, 0] = 1.
+    exparray1 = 2. * np.exp(np.outer(azims[ists] + delta, orders) * 1j)
+    exparray1[:, 0] = 1.
+    group_exparrays.append(exparray)
+    group_exparrays1.append(exparray1)
 
-    # write vtk
-    if args.verbose and iproc == 0:
-        clock0 = time.clock()
-        print('Generating snapshot...')
-    for it, istep in enumerate(steps):
-        if it % args.nproc != iproc: 
-            continue
-        if args.min_step is not None:
-            if it < args.min_step:
-                continue
-        if args.max_step is not None:
-            if it > args.max_step:
-                continue  
-        disp_curl = np.zeros(nstation)
-        eleTag_last = -1
-        fourier_last = None
-        for istation, dist in enumerate(dists):
-            # poles cannot be computed correctly
-            if (dist < delta or dist > np.pi - delta):
-                disp_curl[istation] = 0.
-                continue
-            if eleTags[istation] == eleTag_last:
-                fourier = fourier_last
-            else:
-                fourier_r = nc_surf_local.variables['edge_' + str(eleTags[istation]) + 'r'][istep, :]
-                fourier_i = nc_surf_local.variables['edge_' + str(eleTags[istation]) + 'i'][istep, :]
-                fourier = fourier_r[:] + fourier_i[:] * 1j
-                fourier_last = fourier
-                eleTag_last = eleTags[istation]
-            nu_p_1 = int(len(fourier) / nPntEdge / 3)
-            wdotf = np.zeros((3, nu_p_1), dtype=fourier.dtype)
-            wdotf1 = np.zeros((3, nu_p_1), dtype=fourier.dtype)
-            for idim in np.arange(0, 3):
-                start = idim * nPntEdge * nu_p_1
-                end = idim * nPntEdge * nu_p_1 + nPntEdge * nu_p_1
-                fmat = fourier[start:end].reshape(nPntEdge, nu_p_1)
-                wdotf[idim] = weights[istation].dot(fmat)
-                wdotf1[idim] = weights1[istation].dot(fmat)
-            exparray = 2. * np.exp(np.arange(0, nu_p_1) * 1j * azims[istation])
-            exparray[0] = 1.
-            exparray1 = 2. * np.exp(np.arange(0, nu_p_1) * 1j * (azims[istation] + delta))
-            exparray1[0] = 1.
-            spz = wdotf.dot(exparray).real
-            spz_dist1 = wdotf1.dot(exparray).real
-            spz_azim1 = wdotf.dot(exparray1).real
-            uR = spz[0] * np.cos(dist) - spz[2] * np.sin(dist)
-            uR_azim1 = spz_azim1[0] * np.cos(dist) - spz_azim1[2] * np.sin(dist)
-            duR = (uR_azim1 - uR) / delta / np.sin(dist)
-            uT = spz[1]
-            uT_dist1 = spz_dist1[1]
-            duT = (uT_dist1 - uT) / (dists1[istation] - dist)
-            disp_curl[istation] = duR - duT
-        vtk = pyvtk.VtkData(vtk_points,
-            pyvtk.PointData(pyvtk.Scalars(disp_curl, name='disp_curl')), 
-            'surface animation')
-        vtk.tofile(args.out_vtk + '/surface_vtk_zcurl.' + str(it) + '.vtk', 'binary')
-        if args.verbose:
-            print('    Done with snapshot t = %f s; tstep = %d / %d; iproc = %d' \
-                % (var_time[istep], it + 1, len(steps), iproc))
-    # close
-    nc_surf_local.close()
+# netCDF4 is not thread-safe; reads are serialised by this lock
+# while the computation runs in parallel
+nc_lock = threading.Lock()
+def write_vtk(it):
+    istep = steps[it]
+    # read all elements of this snapshot at once
+    fourier_groups = []
+    with nc_lock:
+        for etag in group_tags:
+            fourier_r = nc_surf.variables['edge_' + str(etag) + 'r'][istep, :]
+            fourier_i = nc_surf.variables['edge_' + str(etag) + 'i'][istep, :]
+            fourier_groups.append(fourier_r[:] + fourier_i[:] * 1j)
     
-    # remove temp nc
-    if args.nproc > 1:
-        os.remove(tempnc)
+    # spz at the point and at its neighbours in distance and azimuth
+    spz = np.zeros((nstation, 3))
+    spz_dist1 = np.zeros((nstation, 3))
+    spz_azim1 = np.zeros((nstation, 3))
+    for igroup, ists in enumerate(group_points):
+        fourier = fourier_groups[igroup]
+        nu_p_1 = int(len(fourier) / nPntEdge / 3)
+        fmat = fourier.reshape(3, nPntEdge, nu_p_1)
+        # (point, GLL) x (dim, GLL, order) -> (point, dim, order)
+        wdotf = np.einsum('sp,dpk->sdk', weights[ists], fmat)
+        wdotf1 = np.einsum('sp,dpk->sdk', weights1[ists], fmat)
+        exparray = group_exparrays[igroup]
+        exparray1 = group_exparrays1[igroup]
+        spz[ists] = np.einsum('sdk,sk->sd', wdotf, exparray).real
+        spz_dist1[ists] = np.einsum('sdk,sk->sd', wdotf1, exparray).real
+        spz_azim1[ists] = np.einsum('sdk,sk->sd', wdotf, exparray1).real
     
-    if args.verbose and iproc == 0:
-        elapsed = time.clock() - clock0
-        print('Generating snapshots done, ' + 
-              '%f sec elapsed.' % (elapsed))
+    # curl
+    dist = dists[inner]
+    spz = spz[inner]
+    spz_dist1 = spz_dist1[inner]
+    spz_azim1 = spz_azim1[inner]
+    uR = spz[:, 0] * np.cos(dist) - spz[:, 2] * np.sin(dist)
+    uR_azim1 = spz_azim1[:, 0] * np.cos(dist) - spz_azim1[:, 2] * np.sin(dist)
+    duR = (uR_azim1 - uR) / delta / np.sin(dist)
+    uT = spz[:, 1]
+    uT_dist1 = spz_dist1[:, 1]
+    duT = (uT_dist1 - uT) / (dists1[inner] - dist)
+    disp_curl = np.zeros(nstation)
+    disp_curl[inner] = duR - duT
+    with open(args.out_vtk + '/surface_vtk_zcurl.' + str(it) + '.vtk', 'wb') as fvtk:
+        fvtk.write(vtk_header)
+        fvtk.write(vtkPointData(disp_curl, 'disp_curl'))
+    if args.verbose:
+        print('    Done with snapshot t = %f s; tstep = %d / %d' \
+            % (var_time[istep], it + 1, len(steps)))
+
+# snapshots to write
+its = []
+for it in np.arange(len(steps)):
+    if args.min_step is not None:
+        if it < args.min_step:
+            continue
+    if args.max_step is not None:
+        if it > args.max_step:
+            continue  
+    its.append(it)
 
 # write_vtk in parallel
+if args.verbose:
+    clock0 = time.perf_counter()
+    print('Generating snapshot...')
 args.nproc = max(args.nproc, 1)
-if args.nproc == 1:
-    write_vtk(0)
-else:
-    with Pool(args.nproc) as p:
-        p.map(write_vtk, range(0, args.nproc))
-        
-
+with ThreadPoolExecutor(max_workers=args.nproc) as executor:
+    # consume the results to raise exceptions from the workers
+    list(executor.map(write_vtk, its))
+nc_surf.close()
+if args.verbose:
+    elapsed = time.perf_counter() - clock0
+    print('Generating snapshots done, ' + 
+          '%f sec elapsed.' % (elapsed))